@@ -2,6 +2,8 @@
 # IMPORTS
 # =============================================================================
 import os, boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
 from dotenv import load_dotenv
 from pprint import pprint
 import datetime as dt
@@ -17,10 +19,28 @@ session = boto3.Session(
     aws_access_key_id=AWS_ACCESS_KEY,
     aws_secret_access_key=AWS_SECRET_KEY,
 )
-dynamodb = session.resource("dynamodb", region_name="eu-west-2")
-EVENTS = dynamodb.Table("Events")
+# bigger pool + keepalive so concurrent queries neither serialize on the default
+# 10-conn pool nor pay a TLS handshake per call; adaptive retries absorb throttles
+BOTO_CONFIG = Config(
+    max_pool_connections=32,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive", "max_attempts": 10},
+)
+dynamodb = session.resource("dynamodb", region_name="eu-west-2", config=BOTO_CONFIG)
 BALANCES_TABLE = dynamodb.Table("Balances")
 TMR_TABLE = dynamodb.Table("TimeWeightedReturns")
+# hot queries go through the low-level client to skip the Resource layer overhead
+CLIENT = dynamodb.meta.client
+SERIALIZER = TypeSerializer()
+DESERIALIZER = TypeDeserializer()
+
+# query expressions that never change between calls, built once
+BAL_KCE = "#pk = :pk AND #sk >= :start"
+BAL_EAN = {"#pk": "name", "#sk": "epoch#timestamp"}
+BAL_PROJECTION = "balance, #sk, update_type, fees_n_deposits"
+TMR_KCE = "#n = :v"
+TMR_EAN = {"#n": "name", "#ts": "timestamp"}
+TMR_PROJECTION = "epoch, #ts"
 
 
 # =============================================================================
@@ -36,85 +56,65 @@ TMR_TABLE = dynamodb.Table("TimeWeightedReturns")
 # =============================================================================
 class TimeWeightedReturns:
     EPOCH_N = 5  # len of epoch string in sort key (e.g.: 00002#2023-01-10 00:00:00)
-    TIME_DELTA = 8  # the amount of hours we fetch for
 
-    def __init__(self, name):
+    def __init__(self, name, prev_pnl=None):
         self.name = name
-        self.now_str = dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        # last record of the previous window: its final pnl, or its final
+        # balance when the window emitted no pnls (both carry epoch/timestamp)
+        self.prev_pnl = prev_pnl
+        self.now_str = dt.datetime.utcnow().isoformat(sep=" ", timespec="seconds")
 
     # =============================================================================
     # MAIN
     # =============================================================================
-    def main(self):
+    def main(self, batch_writer):
         self.get_most_recent_update_n_build_start_str()
-        self.get_all_epochs()
         self.determine_window_n_fetch_balances()
-        self.determine_period_cutoffs()
         self.determine_period_percentage_pnls()
-        self.save_pnls_to_db()
+        self.save_pnls_to_db(batch_writer)
         return self.pnls
 
     # =============================================================================
     # QUERY FOR MOST RECENT UPDATE IN TWR TABLE, BUILD START_STR FOR BALANCES TABLE
     # =============================================================================
     def get_most_recent_update_n_build_start_str(self):
-        kce, ean, eav = "#n = :v", {"#n": "name"}, {":v": "bevy_fund"}
+        if self.prev_pnl is not None:  # we just wrote it, no need to query it back
+            self.start = f"{self.prev_pnl['epoch']}#{self.prev_pnl['timestamp']}"
+            return
+        eav = {":v": "bevy_fund"}
         limit, sfi = 1, False
-        res = self.query_dynamodb(TMR_TABLE, kce, ean, eav, limit, sfi)[0]
+        res = self.query_dynamodb(
+            TMR_TABLE, TMR_KCE, TMR_EAN, eav, limit, sfi, projection=TMR_PROJECTION
+        )[0]
         self.start = f"{res['epoch']}#{res['timestamp']}"
 
     # =============================================================================
-    # QUERY FOR MOST RECENT UPDATE IN TWR TABLE, BUILD START_STR FOR BALANCES TABLE
-    # =============================================================================
-    def get_all_epochs(self):
-        KCE = "#pk = :pk"
-        EAN = {"#pk": "event"}
-        EAV = {":pk": "epoch"}
-        res = self.query_dynamodb(EVENTS, KCE, EAN, EAV)
-        self.epochs = [
-            {"epoch": str(r["info"]["epoch"]), "timestamp": r["timestamp"]} for r in res
-        ]
-
-    # =============================================================================
-    # NORMALLY, WINDOW = 8hrs, BUT SOMETIMES NO UPDATE EXISTS IN WINDOW. THEN WE NEED
-    # TO INCREASE WINDOW SIZE INCREMENTALLY
+    # FETCH THE NEXT TWO BALANCES FROM START ONWARDS. ONE FORWARD QUERY WITH LIMIT
+    # REPLACES THE OLD WIDENING-WINDOW PROBING LOOP (ONE ROUND-TRIP INSTEAD OF N)
     # =============================================================================
     def determine_window_n_fetch_balances(self):
-        n = 1
-        start_obj = self.dt_str_to_obj(self.start.split("#")[-1])
-        dt.timedelta(hours=8 * n)
-        while True:
-            end = self.determine_end_sort_key(start_obj, n)
-            balances = self.fetch_balances_for_window(end)
-            n += 1
-
-            if len(balances) > 1:  # Need at least 2 to compute pnl
-                break
-            if end.split("#")[-1] > self.now_str:  # don't iterate into future
-                break
-            if len(balances) == 0:
-                raise Exception("Should always return at least one balance")
+        balances = self.fetch_balances_for_window()
+        if len(balances) == 0:
+            raise Exception("Should always return at least one balance")
         self.balances = balances
 
-    # =============================================================================
-    # DETERMINE THE UPPER BOUND SORT KEY FOR QUERYING FOR BALANCES
-    # =============================================================================
-    def determine_end_sort_key(self, start_obj, n):
-        end_obj = start_obj + dt.timedelta(hours=self.TIME_DELTA * n)
-        end_str = self.dt_obj_to_str(end_obj)
-        epoch = max([e["epoch"] for e in self.epochs if e["timestamp"] < end_str])
-        return f"{'0' * (self.EPOCH_N - len(epoch)) + epoch}#{end_str}"
-
     # =============================================================================
     # FETCH PERIODS FOR SPECIFIC TIME PERIOD
     # =============================================================================
-    def fetch_balances_for_window(self, end):
-        print(self.start, end, "\n")
-        KCE = "#pk = :pk AND #sk BETWEEN :start AND :end"
-        EAN = {"#pk": "name", "#sk": "epoch#timestamp"}
-        EAV = {":pk": self.name, ":start": self.start, ":end": end}
-        bals = self.query_dynamodb(BALANCES_TABLE, KCE, EAN, EAV)
-        return self.clean_balances_from_db(bals)
+    def fetch_balances_for_window(self):
+        print(self.start, "\n")
+        EAV = {":pk": self.name, ":start": self.start}
+        bals = self.query_dynamodb(
+            BALANCES_TABLE,
+            BAL_KCE,
+            BAL_EAN,
+            EAV,
+            limit=2,
+            sif=True,
+            projection=BAL_PROJECTION,
+        )
+        bals = self.clean_balances_from_db(bals)
+        return [b for b in bals if b["timestamp"] <= self.now_str]
 
     # =============================================================================
     # CLEAN RESPONSE FROM DYNAMODB TO ONLY INCLUDE RELEVANT STUFF
@@ -124,10 +124,12 @@ class TimeWeightedReturns:
         for r in unprocessed:
             deposit = r.get("fees_n_deposits", {}).get("deposit", 0)
             init_bal = r.get("fees_n_deposits", {}).get("init_bal", None)
+            epoch, timestamp = r["epoch#timestamp"].split("#", 1)  # split once here
             balances.append(
                 {
                     "balance": r["balance"],
-                    "epoch#timestamp": r["epoch#timestamp"],
+                    "epoch": epoch,
+                    "timestamp": timestamp,
                     "update_type": r["update_type"],
                     "deposit": deposit,
                     "pre_deposit": init_bal,
@@ -136,51 +138,57 @@ class TimeWeightedReturns:
         return balances
 
     # =============================================================================
-    # DETERMINE PERIOD CUT-OFFS, IF THERE ARE ANY
-    # =============================================================================
-    def determine_period_cutoffs(self):
-        periods = []
-        for i, bal in enumerate(self.balances):
-            if i == 0:  # always append first
-                periods.append(bal)
-            elif bal["deposit"] != 0:  # append if deposit/withdraw
-                periods.append(bal)
-            elif i == len(self.balances) - 1:  # always append last
-                periods.append(bal)
-        self.periods = periods
-
-    # =============================================================================
-    # DETERMINE PERIOD PNL, IF THERE ARE MULTIPLE PERIODS, ADJUST
+    # DETERMINE PERIOD PNLS IN A SINGLE PASS: A BALANCE IS A PERIOD CUT-OFF IF IT IS
+    # FIRST, LAST, OR A DEPOSIT/WITHDRAW. EMIT A PNL BETWEEN CONSECUTIVE CUT-OFFS
     # =============================================================================
     def determine_period_percentage_pnls(self):
-        pnls = []
-        for start, end in zip(self.periods, self.periods[1:]):
-            end_bal = end["pre_deposit"] or end["balance"]
-            pnl = (end_bal - start["balance"]) / start["balance"]
+        # fast path: no deposits means exactly one period, first balance to last
+        if len(self.balances) > 1 and not any(b["deposit"] for b in self.balances):
+            record = self.build_pnl_record(self.balances[0], self.balances[-1])
+            self.pnls = [record] if record is not None else []
+            pprint(self.pnls)
+            return
 
-            epoch = end["epoch#timestamp"].split("#")[0]
-            end_timestamp = end["epoch#timestamp"].split("#")[-1]
-            start_timestamp = start["epoch#timestamp"].split("#")[-1]
-
-            pnls.append(
-                {
-                    "name": self.name,
-                    "pnl": pnl,
-                    "timestamp": end_timestamp,
-                    "period_start": start_timestamp,
-                    "epoch": epoch,
-                }
+        pnls = []
+        start = None
+        for i, bal in enumerate(self.balances):
+            is_cutoff = (
+                i == 0 or bal["deposit"] != 0 or i == len(self.balances) - 1
             )
+            if not is_cutoff:
+                continue
+            if start is not None:
+                record = self.build_pnl_record(start, bal)
+                if record is not None:
+                    pnls.append(record)
+            start = bal
         self.pnls = pnls
         pprint(self.pnls)
 
     # =============================================================================
-    # DETERMINE PERIOD PNL, IF THERE ARE MULTIPLE PERIODS, ADJUST
+    # BUILD ONE PNL RECORD FOR THE PERIOD BETWEEN TWO CUT-OFF BALANCES. RETURNS
+    # None FOR A ZERO START BALANCE, WHERE A PERCENTAGE PNL IS UNDEFINED
+    # =============================================================================
+    def build_pnl_record(self, start, end):
+        if not start["balance"]:
+            return None
+        # explicit None check: a pre_deposit of 0 must not fall back to balance
+        end_bal = end["pre_deposit"] if end["pre_deposit"] is not None else end["balance"]
+        pnl = (end_bal - start["balance"]) / start["balance"]
+        return {
+            "name": self.name,
+            "pnl": pnl,
+            "timestamp": end["timestamp"],
+            "period_start": start["timestamp"],
+            "epoch": end["epoch"],
+        }
+
     # =============================================================================
-    def save_pnls_to_db(self):
-        with TMR_TABLE.batch_writer() as batch:
-            for record in self.pnls:
-                batch.put_item(Item=record)
+    # HAND PNLS TO THE DRIVER'S BATCH WRITER, SO ALL RUNS SHARE ONE WRITE FAN-OUT
+    # =============================================================================
+    def save_pnls_to_db(self, batch_writer):
+        for record in self.pnls:
+            batch_writer.put_item(Item=record)
 
     # =============================================================================
     #
@@ -189,34 +197,53 @@ class TimeWeightedReturns:
     # =============================================================================
     # QUERY DYNAMODB
     # =============================================================================
-    def query_dynamodb(self, table, kce, ean, eav, limit=None, sif=None):
+    def query_dynamodb(self, table, kce, ean, eav, limit=None, sif=None, projection=None):
         query_kwargs = {
+            "TableName": table.name,
             "KeyConditionExpression": kce,
             "ExpressionAttributeNames": ean,
-            "ExpressionAttributeValues": eav,
+            "ExpressionAttributeValues": {
+                k: SERIALIZER.serialize(v) for k, v in eav.items()
+            },
         }
         if limit is not None:
             query_kwargs["Limit"] = limit
         if sif is not None:
             query_kwargs["ScanIndexForward"] = sif
+        if projection is not None:  # only read the attributes we actually use
+            query_kwargs["ProjectionExpression"] = projection
 
-        res = table.query(**query_kwargs)
-        return res.get("Items", [])
-
-    # =============================================================================
-    # CONVERT DATETIME OBJECT TO STR
-    # =============================================================================
-    def dt_obj_to_str(self, dt_obj):
-        return dt_obj.strftime("%Y-%m-%d %H:%M:%S")
+        # every query in this tree carries a small Limit, so a single response
+        # is always complete (no LastEvaluatedKey to follow)
+        res = CLIENT.query(**query_kwargs)
+        return [self.deserialize_item(i) for i in res.get("Items", [])]
 
     # =============================================================================
-    # CONVERT DATETIME STR TO OBJ
+    # CONVERT A LOW-LEVEL DYNAMODB ITEM ({'S': ...} etc.) BACK TO PLAIN VALUES
     # =============================================================================
-    def dt_str_to_obj(self, dt_str):
-        return dt.datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
+    def deserialize_item(self, item):
+        return {k: DESERIALIZER.deserialize(v) for k, v in item.items()}
 
 
 if __name__ == "__main__":
-    obj = TimeWeightedReturns("bevy_fund")
+    # catch up over as many windows as the data allows instead of one window per
+    # invocation. Windows are serially dependent (each start key comes from the
+    # previous TWR write), so they run in sequence, not fanned out
     pnls = []
-    obj.main()
+    prev_pnl = None
+    with TMR_TABLE.batch_writer(overwrite_by_pkeys=["name", "timestamp"]) as batch:
+        while True:
+            obj = TimeWeightedReturns("bevy_fund", prev_pnl=prev_pnl)
+            window_pnls = obj.main(batch_writer=batch)
+            pnls.extend(window_pnls)
+            if len(obj.balances) < 2:  # caught up: no complete window left
+                break
+            # a window can legitimately emit no records (e.g. zero start
+            # balance); still advance past it so the loop doesn't wedge there
+            prev_pnl = window_pnls[-1] if window_pnls else obj.balances[-1]
+
+    # compound the period pnls in one pass, no intermediate frame/list
+    cumulative = 1.0
+    for record in pnls:
+        cumulative *= 1 + float(record["pnl"])
+    print(f"{len(pnls)} periods, cumulative pnl: {cumulative - 1:.6f}")